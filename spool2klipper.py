@@ -17,20 +17,66 @@ import asyncio
 import logging
 import os
 import shutil
+import signal
 import sys
-from typing import Any, Dict, List, Optional, Union
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union
 from pathlib import Path
 
 
 import aiohttp
 from jsonrpc_websocket import Server
-import toml
+import orjson
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # pylint: disable=C0103
 
 
 PROGNAME = "spool2klipper"
+# Placeholder, only reported to Moonraker; there are no releases yet.
+PROGVERSION = "0.1.0"
+PROGURL = "https://github.com/psyfiend/spool2klipper"
 CFG_DIR = "~/.config/" + PROGNAME
 CFG_FILE = PROGNAME + ".cfg"
 
+log = logging.getLogger(__name__)
+
+# Klipper's object name prefix for gcode macros.
+GCODE_MACRO_PREFIX = "gcode_macro "
+
+# Number of spools, and for how many seconds, to remember Spoolman's answers.
+SPOOL_CACHE_SIZE = 16
+SPOOL_CACHE_TTL = 30.0
+
+# Seconds to wait for more active spool changes before applying the last one.
+SPOOL_DEBOUNCE = 0.2
+
+# Timeout, in seconds, for a request to Spoolman.
+SPOOLMAN_TIMEOUT = 10
+
+
+@dataclass(frozen=True)
+class FetchError:
+    """A failed attempt to fetch data from Spoolman"""
+
+    status: Optional[int]  # None if no response was received
+    body: str
+
+    def __str__(self) -> str:
+        if self.status is None:
+            return self.body
+        return f"HTTP status {self.status}: {self.body}"
+
 
 # pylint: disable=R0902,R0903
 class Spool2Klipper:
@@ -38,6 +84,20 @@ class Spool2Klipper:
 
     def __init__(self, config: Dict[str, Any]):
         self.gcode_macros: List[str] = []
+        self.gcode_macro_set: FrozenSet[str] = frozenset()
+        self._has_set_macros = False
+        self._has_clear_macro = False
+        self._has_done_macro = False
+        # Prefixes, ending with "_", of set macros' names. Nested spool
+        # data is only looked at if a macro starts with its prefix.
+        self._set_macro_prefixes: FrozenSet[str] = frozenset()
+        # Spoolman fields that might be used by the set macros.
+        self._wanted_fields: List[str] = []
+        self._tasks: Set[asyncio.Task] = set()
+        self._spool_lock: Optional[asyncio.Lock] = None
+        self._debounce_task: Optional[asyncio.Task] = None
+        self._pending_params: Dict[str, Any] = {}
+        self._stop: Optional[asyncio.Event] = None
         self.http_session = None
         self.moonraker_server = None
         self.moonraker_url = config[PROGNAME]["moonraker_url"]
@@ -48,118 +108,279 @@ class Spool2Klipper:
         self.klipper_spool_clear_macro = config[PROGNAME]["klipper_spool_clear_macro"]
         self.klipper_spool_done = config[PROGNAME]["klipper_spool_done"]
         self.spoolman_url = config[PROGNAME]["spoolman_url"]
+        # spool_id -> (fetch time, ETag, spool data)
+        self._spool_cache: (
+            "OrderedDict[int, Tuple[float, Optional[str], Dict[str, Any]]]"
+        ) = OrderedDict()
+
+    def _cache_spool_info(
+        self, spool_id: int, etag: Optional[str], spool_data: Dict[str, Any]
+    ) -> None:
+        self._spool_cache[spool_id] = (time.monotonic(), etag, spool_data)
+        self._spool_cache.move_to_end(spool_id)
+        while len(self._spool_cache) > SPOOL_CACHE_SIZE:
+            self._spool_cache.popitem(last=False)
 
     async def _fetch_spool_info(
         self, spool_id: Union[int, None]
-    ) -> Optional[Union[Dict[str, Any], Exception]]:
+    ) -> Optional[Union[Dict[str, Any], FetchError]]:
+        cached = self._spool_cache.get(spool_id)
+        headers = {}
+        if cached is not None:
+            fetched_at, etag, spool_data = cached
+            if time.monotonic() - fetched_at < SPOOL_CACHE_TTL:
+                log.debug("Using cached data for spool id=%s", spool_id)
+                self._spool_cache.move_to_end(spool_id)
+                return spool_data
+            if etag is not None:
+                headers["If-None-Match"] = etag
         try:
+            params = {}
+            if self._wanted_fields:
+                params["fields"] = ",".join(self._wanted_fields)
             async with await self.http_session.get(
                 f"{self.spoolman_url}/v1/spool/{spool_id}",
+                headers=headers,
+                params=params,
             ) as response:
+                if response.status == 304 and cached is not None:
+                    self._cache_spool_info(spool_id, cached[1], cached[2])
+                    return cached[2]
                 if response.status == 404:
+                    self._spool_cache.pop(spool_id, None)
                     return None
                 if response.status == 200:
-                    return await response.json()
-                return Exception(await response.text())
-        except aiohttp.client_exceptions.ClientConnectorError as e:
-            return e
+                    # pylint: disable-next=E1101
+                    spool_data = orjson.loads(await response.read())
+                    self._cache_spool_info(
+                        spool_id, response.headers.get("ETag"), spool_data
+                    )
+                    return spool_data
+                body = ""
+                if log.isEnabledFor(logging.INFO):
+                    body = await response.text()
+                return FetchError(response.status, body)
+        except (
+            aiohttp.client_exceptions.ClientConnectorError,
+            asyncio.TimeoutError,
+        ) as e:
+            return FetchError(None, self._get_response_error(e))
 
-    async def _get_response_error(self, response: Exception) -> str:
+    def _get_response_error(self, response: Exception) -> str:
         if isinstance(response, aiohttp.client_exceptions.ClientConnectorError):
             err_msg = f"Failed to connect to server: {response}"
-        elif isinstance(response, Exception):
-            err_msg = f"Unknown error: {response}"
+        elif isinstance(response, asyncio.TimeoutError):
+            err_msg = "Timeout waiting for the server"
         else:
             err_msg = f"Unknown error: {response}"
         return err_msg
 
-    def _has_spoolman_set_macros(self) -> bool:
-        prefix = self.klipper_spool_set_macro_prefix
-        for k in self.gcode_macros:
-            if k.startswith(prefix):
-                return True
-        return False
+    def _on_active_spool_set(self, params: Dict[str, Any]) -> None:
+        # Handlers are awaited by the websocket's receive loop,
+        # so do the work in a task instead of blocking it.
+        # Only the last of several changes in quick succession is applied.
+        self._pending_params = params
+        if self._debounce_task is not None:
+            self._debounce_task.cancel()
+        task = asyncio.get_running_loop().create_task(self._apply_spool())
+        self._debounce_task = task
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Failed to handle active spool change", exc_info=task.exception())
+
+    async def _apply_spool(self) -> None:
+        await asyncio.sleep(SPOOL_DEBOUNCE)
+        # From here on, the change is applied even if a new one arrives.
+        self._debounce_task = None
+        params = self._pending_params
+        # The lock wakes waiters in order, so Klipper sees the changes
+        # in the order Moonraker sent them.
+        async with self._spool_lock:
+            await self._notify_active_spool_set(params)
 
     async def _notify_active_spool_set(self, params: Dict[str, Any]) -> None:
         spool_id = params["spool_id"]
         if spool_id is not None:
-            if self._has_spoolman_set_macros():
-                logging.debug("Fetching data from Spoolman id=%s", spool_id)
+            if self._has_set_macros:
+                log.debug("Fetching data from Spoolman id=%s", spool_id)
                 spool_data = await self._fetch_spool_info(spool_id)
                 if spool_data is None:
-                    logging.info("Spool ID %s not found, clearing fields", spool_id)
-                    await self._run_gcode(self.klipper_spool_clear_macro)
-                if isinstance(spool_data, Exception):
-                    err_msg = self._get_response_error(spool_data)
-                    logging.info("Attempt to fetch spool info failed: %s", err_msg)
+                    log.info("Spool ID %s not found, clearing fields", spool_id)
+                    if self._has_clear_macro:
+                        await self._run_gcode(self.klipper_spool_clear_macro)
+                elif isinstance(spool_data, FetchError):
+                    log.info("Attempt to fetch spool info failed: %s", spool_data)
                 else:
                     spool_data: Dict[str, Any] = spool_data
-                    logging.info("Fetched Spool data for ID %s", spool_id)
-                    logging.debug("Got data from Spoolman: %s", spool_data)
-                    await self._run_gcode(self.klipper_spool_clear_macro)
-                    await self._call_klipper_with_data(
-                        self.klipper_spool_set_macro_prefix,
-                        spool_data,
-                    )
-
-                    if self.klipper_spool_done in self.gcode_macros:
-                        await self._run_gcode(self.klipper_spool_done)
+                    log.info("Fetched Spool data for ID %s", spool_id)
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("Got data from Spoolman: %s", spool_data)
+                    scripts = self._spool_scripts(spool_data)
+                    if scripts:
+                        await self._run_gcode("\n".join(scripts))
             else:
-                logging.debug("No spoolman gcode set macros found")
+                log.debug("No spoolman gcode set macros found")
         else:
-            if self.klipper_spool_clear_macro in self.gcode_macros:
+            if self._has_clear_macro:
                 await self._run_gcode(self.klipper_spool_clear_macro)
             else:
-                logging.debug("No spoolman gcode clear macro found")
+                log.debug("No spoolman gcode clear macro found")
 
-    async def _call_klipper_with_data(
+    def _spool_scripts(self, spool_data: Dict[str, Any]) -> List[str]:
+        scripts: List[str] = []
+        if self._has_clear_macro:
+            scripts.append(self.klipper_spool_clear_macro)
+        scripts.extend(
+            self._collect_scripts(self.klipper_spool_set_macro_prefix, spool_data)
+        )
+        if self._has_done_macro:
+            scripts.append(self.klipper_spool_done)
+        return scripts
+
+    def _collect_scripts(
         self,
         prefix: str,
-        spool_data: Any,
-    ) -> None:
-
-        for key, val in spool_data.items():
+        spool_data: Dict[str, Any],
+    ) -> List[str]:
+        out: List[str] = []
+        # Walk the nested dicts depth first, in the data's order.
+        stack = [(prefix, iter(spool_data.items()))]
+        while stack:
+            prefix, items = stack[-1]
+            item = next(items, None)
+            if item is None:
+                stack.pop()
+                continue
+            key, val = item
             macro_name = prefix + key
-            if isinstance(val, dict):
-                await self._call_klipper_with_data(macro_name + "_", val)
-            elif macro_name in self.gcode_macros:
-                if isinstance(val, (int, float)):
-                    script = f"{macro_name} VALUE={val}"
+            # The data comes from orjson, so exact types can be compared.
+            val_type = type(val)
+            if val_type is dict:
+                sub_prefix = macro_name + "_"
+                if sub_prefix in self._set_macro_prefixes:
+                    stack.append((sub_prefix, iter(val.items())))
+            elif macro_name in self.gcode_macro_set:
+                if val_type is int or val_type is float or val_type is bool:
+                    out.append(f"{macro_name} VALUE={val}")
+                elif val_type is str:
+                    if '"' in val:
+                        val = val.replace('"', "''")
+                    # The scripts are sent as one, so a line break in a
+                    # value would end this command and start another.
+                    if "\n" in val or "\r" in val:
+                        val = " ".join(val.splitlines())
+                    out.append(f'{macro_name} VALUE="{val}"')
                 else:
-                    val = val.replace('"', "''")
-                    script = f'{macro_name} VALUE="{val}"'
-                await self._run_gcode(script)
+                    # Unset (None) fields and lists have no value
+                    # to pass to a macro, so skip them.
+                    log.debug("Skipping %s, it has no usable value", macro_name)
+        return out
 
     async def _run_gcode(self, script):
-        logging.info("Run in klipper: '%s'", script)
+        log.info("Run in klipper: '%s'", script)
         await self.moonraker_server.printer.gcode.script(
             script=script, _notification=True
         )
 
+    def _set_gcode_macros(self, objects: List[str]) -> None:
+        plen = len(GCODE_MACRO_PREFIX)
+        self.gcode_macros = [
+            x[plen:] for x in objects if x.startswith(GCODE_MACRO_PREFIX)
+        ]
+        self.gcode_macro_set = frozenset(self.gcode_macros)
+        prefix = self.klipper_spool_set_macro_prefix
+        self._has_set_macros = any(m.startswith(prefix) for m in self.gcode_macros)
+        self._has_clear_macro = self.klipper_spool_clear_macro in self.gcode_macro_set
+        self._has_done_macro = self.klipper_spool_done in self.gcode_macro_set
+        self._set_macro_prefixes = frozenset(
+            m[: i + 1]
+            for m in self.gcode_macros
+            if m.startswith(prefix)
+            for i in range(len(prefix), len(m))
+            if m[i] == "_"
+        )
+        # Field names can contain "_" too, so every "_" separated start
+        # of a macro's name might be the name of a top level field.
+        skip = len(prefix)
+        self._wanted_fields = sorted(
+            {m[skip:] for m in self.gcode_macros if m.startswith(prefix)}
+            | {p[skip:-1] for p in self._set_macro_prefixes}
+        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Available macros: %s", (self.gcode_macros))
+
+    def _ws_closed(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Lost connection to Moonraker", exc_info=task.exception())
+        self._stop.set()
+
+    async def _connect(self) -> None:
+        ws_task = await self.moonraker_server.ws_connect()
+        # Stop if the websocket connection is lost.
+        ws_task.add_done_callback(self._ws_closed)
+
+        _, objects = await asyncio.gather(
+            self.moonraker_server.server.connection.identify(
+                client_name=PROGNAME,
+                version=PROGVERSION,
+                type="agent",
+                url=PROGURL,
+            ),
+            self.moonraker_server.printer.objects.list(),
+        )
+        self._set_gcode_macros(objects["objects"])
+
+        self.moonraker_server.notify_active_spool_set = self._on_active_spool_set
+
     async def _routine(self):
-        async with aiohttp.ClientSession() as self.http_session:
+        async with AsyncExitStack() as stack:
+            self.http_session = await stack.enter_async_context(
+                aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=4,
+                        limit_per_host=2,
+                        keepalive_timeout=300,
+                        ttl_dns_cache=600,
+                    ),
+                    timeout=aiohttp.ClientTimeout(total=SPOOLMAN_TIMEOUT),
+                    headers={"Accept": "application/json", "Connection": "keep-alive"},
+                )
+            )
             self.moonraker_server = Server(self.moonraker_url)
-            try:
-                await self.moonraker_server.ws_connect()
+            stack.push_async_callback(self.moonraker_server.close)
 
-                objects = await self.moonraker_server.printer.objects.list()
-                self.gcode_macros = [
-                    x[12:] for x in objects["objects"] if x.startswith("gcode_macro ")
-                ]
-                logging.debug("Available macros: %s", (self.gcode_macros))
+            self._spool_lock = asyncio.Lock()
+            self._stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self._stop.set)
 
-                self.moonraker_server.notify_active_spool_set = (
-                    self._notify_active_spool_set
+            # Moonraker might never answer during startup,
+            # so stop waiting for it when asked to stop.
+            startup = asyncio.ensure_future(self._connect())
+            stopping = asyncio.ensure_future(self._stop.wait())
+            try:
+                await asyncio.wait(
+                    (startup, stopping), return_when=asyncio.FIRST_COMPLETED
                 )
-
-                while True:
-                    await asyncio.sleep(3600)
+                if startup.done():
+                    startup.result()
+                await stopping
             finally:
-                await self.moonraker_server.close()
+                startup.cancel()
+                stopping.cancel()
+            log.info("Stopping")
 
     def run(self):
         """Run the agent in the async loop"""
-        asyncio.get_event_loop().run_until_complete(self._routine())
+        if uvloop is not None:
+            uvloop.run(self._routine())
+        else:
+            asyncio.run(self._routine())
 
 
 if __name__ == "__main__":
@@ -168,8 +389,8 @@ if __name__ == "__main__":
     for path in ["~/" + CFG_FILE, CFG_DIR + "/" + CFG_FILE]:
         cfg_filename = os.path.expanduser(path)
         if os.path.exists(cfg_filename):
-            with open(cfg_filename, "r", encoding="utf-8") as fp:
-                config_data = toml.load(fp)
+            with open(cfg_filename, "rb") as fp:
+                config_data = tomllib.load(fp)
                 break
 
     if not config_data: